@@ -288,6 +288,30 @@ def delete_by_columns_query(table_name, where_column_value_pairs=None,
   return query, bind_vars
 
 
+def insert_many_query(table_name, columns, rows):
+  """Build a single insert query for rows, a list of value tuples."""
+
+  if not rows:
+    raise ValueError('Expected nonempty rows. Got: %r' % rows)
+
+  values_list = []
+  bind_vars = {}
+  for i, row in enumerate(rows):
+    if len(row) != len(columns):
+      raise ValueError('Expected %d values per row. Got: %r' %
+                       (len(columns), row))
+    bind_list = []
+    for column, value in zip(columns, row):
+      bind_name = '%s_%d' % (column, i)
+      bind_list.append('%%(%s)s' % bind_name)
+      bind_vars[bind_name] = value
+    values_list.append('(%s)' % ', '.join(bind_list))
+
+  query = 'INSERT INTO %s (%s) VALUES %s' % (table_name, colstr(columns),
+                                             ', '.join(values_list))
+  return query, bind_vars
+
+
 def choose_bind_name(base, counter=None):
   if counter:
     base += '_%d' % counter.next()
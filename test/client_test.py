@@ -7,6 +7,8 @@ library test.
 # coding: utf-8
 
 import logging
+from multiprocessing.pool import ThreadPool
+import os
 import struct
 import threading
 import time
@@ -25,6 +27,7 @@ from vtdb import keyrange_constants
 from vtdb import keyspace
 from vtdb import dbexceptions
 from vtdb import shard_constants
+from vtdb import sql_builder
 from vtdb import topology
 from vtdb import vtdb_logger
 from vtdb import vtgatev2
@@ -34,6 +37,11 @@ from zk import zkocc
 conn_class = vtgatev2
 __tablets = None
 
+# Worker pool used to create the tablets' databases concurrently. Those
+# steps only talk to mysql, no process is started from the pool threads.
+# It is created lazily, once the list of tablets is known.
+_POOL = None
+
 vtgate_server = None
 vtgate_port = None
 
@@ -52,18 +60,64 @@ shard_kid_map = {'-80': [527875958493693904, 626750931627689502,
 
 pack_kid = struct.Struct('!Q').pack
 
+# TestUnshardedTable always runs its CRUD checks as the single test_crud.
+# If set, the tests doing one operation each are skipped.
+fused_crud_tests = bool(os.environ.get('CLIENT_TEST_FUSED'))
+
+def _build_plan():
+  """Flattens topo_schema into the lists each setup phase walks through.
+
+  keyspaces: all keyspace names, in topo_schema order.
+  sharded_keyspaces: names of the range sharded keyspaces.
+  shards: (keyspace, shard) pairs, one master and one replica per pair.
+  create_sql: keyspace name -> create statements for its tables.
+  """
+  plan = {'keyspaces': [],
+          'sharded_keyspaces': [],
+          'shards': [],
+          'create_sql': {},
+          }
+  for ks_name, ks_type in topo_schema.keyspaces:
+    plan['keyspaces'].append(ks_name)
+    if ks_type == shard_constants.RANGE_SHARDED:
+      plan['sharded_keyspaces'].append(ks_name)
+      plan['shards'].extend((ks_name, shard_name) for shard_name in shard_names)
+    elif ks_type == shard_constants.UNSHARDED:
+      plan['shards'].append((ks_name, keyrange_constants.SHARD_ZERO))
+    plan['create_sql'][ks_name] = [
+        table_tuple[1] for table_tuple in topo_schema.keyspace_table_map[ks_name]]
+  return plan
+
+_plan = _build_plan()
+
+def _get_pool():
+  global _POOL
+  if _POOL is None:
+    _POOL = ThreadPool(processes=max(1, min(32, len(__tablets))))
+  return _POOL
+
+def _close_pool():
+  global _POOL
+  if _POOL is not None:
+    _POOL.close()
+    _POOL.join()
+    _POOL = None
+
 def setUpModule():
   global vtgate_server, vtgate_port
   logging.debug("in setUpModule")
   try:
     environment.topo_server().setup()
+    # With a vtctld running, the vtctl commands in AUTO mode go over its
+    # RPC connection instead of starting a vtctl process each.
+    utils.Vtctld().start()
     setup_topology()
 
     # start mysql instance external to the test
     global __tablets
     setup_procs = []
-    for tablet in __tablets:
-      setup_procs.append(tablet.init_mysql())
+    for t in __tablets:
+      setup_procs.append(t.init_mysql())
     utils.wait_procs(setup_procs)
     create_db()
     start_tablets()
@@ -72,7 +126,7 @@ def setUpModule():
     # dependency on topology goes away.
     vtgate_client = zkocc.ZkOccConnection("localhost:%u" % vtgate_port,
                                           "test_nj", 30.0)
-    topology.read_topology(vtgate_client)
+    topology.read_keyspaces(vtgate_client)
   except:
     tearDownModule()
     raise
@@ -84,6 +138,7 @@ def tearDownModule():
   if utils.options.skip_teardown:
     return
   logging.debug("Tearing down the servers and setup")
+  close_connections()
   utils.vtgate_kill(vtgate_server)
   if __tablets is not None:
     tablet.kill_tablets(__tablets)
@@ -91,6 +146,7 @@ def tearDownModule():
     for t in __tablets:
       teardown_procs.append(t.teardown_mysql())
     utils.wait_procs(teardown_procs, raise_on_error=False)
+  _close_pool()
 
   environment.topo_server().teardown()
 
@@ -106,48 +162,40 @@ def setup_topology():
   if __tablets is None:
     __tablets = []
 
-  keyspaces = topo_schema.keyspaces
-  for ks in keyspaces:
-    ks_name = ks[0]
-    ks_type = ks[1]
+  for ks_name in _plan['keyspaces']:
     utils.run_vtctl(['CreateKeyspace', ks_name])
-    if ks_type == shard_constants.UNSHARDED:
-      shard_master = tablet.Tablet()
-      shard_replica = tablet.Tablet()
-      shard_master.init_tablet('master', keyspace=ks_name, shard='0')
-      __tablets.append(shard_master)
-      shard_replica.init_tablet('replica', keyspace=ks_name, shard='0')
-      __tablets.append(shard_replica)
-    elif ks_type == shard_constants.RANGE_SHARDED:
-      utils.run_vtctl(['SetKeyspaceShardingInfo', '-force', ks_name,
-                       'keyspace_id', 'uint64'])
-      for shard_name in shard_names:
-        shard_master = tablet.Tablet()
-        shard_replica = tablet.Tablet()
-        shard_master.init_tablet('master', keyspace=ks_name, shard=shard_name)
-        __tablets.append(shard_master)
-        shard_replica.init_tablet('replica', keyspace=ks_name, shard=shard_name)
-        __tablets.append(shard_replica)
+  for ks_name in _plan['sharded_keyspaces']:
+    utils.run_vtctl(['SetKeyspaceShardingInfo', '-force', ks_name,
+                     'keyspace_id', 'uint64'])
+
+  for ks_name, shard_name in _plan['shards']:
+    shard_master = tablet.Tablet()
+    shard_replica = tablet.Tablet()
+    shard_master.init_tablet('master', keyspace=ks_name, shard=shard_name)
+    __tablets.append(shard_master)
+    shard_replica.init_tablet('replica', keyspace=ks_name, shard=shard_name)
+    __tablets.append(shard_replica)
+
+  for ks_name in _plan['keyspaces']:
     utils.run_vtctl(['RebuildKeyspaceGraph', ks_name], auto_log=True)
 
 
+def _do_create_db(t):
+  t.create_db(t.dbname)
+  t.mquery(t.dbname, _plan['create_sql'][t.keyspace])
+
 def create_db():
   global __tablets
-  for t in __tablets:
-    t.create_db(t.dbname)
-    ks_name = t.keyspace
-    for table_tuple in topo_schema.keyspace_table_map[ks_name]:
-      t.mquery(t.dbname, table_tuple[1])
+  _get_pool().map(_do_create_db, __tablets)
 
 def start_tablets():
   global __tablets
-  # start tablets
+  # start tablets, this does not block so it is done serially
   for t in __tablets:
     t.start_vttablet(wait_for_state=None)
 
   # wait for them to come in serving state
-  for t in __tablets:
-    t.wait_for_vttablet_state('SERVING')
+  tablet.wait_for_tablets_state(__tablets, 'SERVING')
 
   # ReparentShard for master tablets
   for t in __tablets:
@@ -155,106 +203,272 @@ def start_tablets():
       utils.run_vtctl(['ReparentShard', '-force', t.keyspace+'/'+t.shard,
                        t.tablet_alias], auto_log=True)
 
-  for ks in topo_schema.keyspaces:
-    ks_name = ks[0]
-    ks_type = ks[1]
-    utils.run_vtctl(['RebuildKeyspaceGraph', ks_name],
-                     auto_log=True)
-    if ks_type == shard_constants.RANGE_SHARDED:
-      utils.check_srv_keyspace('test_nj', ks_name,
-                               'Partitions(master): -80 80-\n' +
-                               'Partitions(replica): -80 80-\n' +
-                               'TabletTypes: master,replica')
+  # all the keyspace graphs are rebuilt once the reparents are done
+  for ks_name in _plan['keyspaces']:
+    utils.run_vtctl(['RebuildKeyspaceGraph', ks_name], auto_log=True)
+  for ks_name in _plan['sharded_keyspaces']:
+    utils.check_srv_keyspace('test_nj', ks_name,
+                             'Partitions(master): -80 80-\n' +
+                             'Partitions(replica): -80 80-\n' +
+                             'TabletTypes: master,replica')
+
+
+# vtgate_addrs of the running vtgate, rebuilt only when its port changes.
+_vtgate_addrs = None
+_vtgate_addrs_port = None
 
+def get_vtgate_addrs():
+  global _vtgate_addrs, _vtgate_addrs_port
+  if _vtgate_addrs is None or _vtgate_addrs_port != vtgate_port:
+    _vtgate_addrs = {"_vt": ["localhost:%s" % (vtgate_port),]}
+    _vtgate_addrs_port = vtgate_port
+  return _vtgate_addrs
+
+# Long-lived vtgate connections handed out by get_connection,
+# one per (user, password).
+_conns = {}
 
 def get_connection(user=None, password=None):
-  global vtgate_port
   timeout = 10.0
-  conn = None
-  vtgate_addrs = {"_vt": ["localhost:%s" % (vtgate_port),]}
-  conn = conn_class.connect(vtgate_addrs, timeout,
-                            user=user, password=password)
+  key = (user, password)
+  conn = _conns.get(key)
+  if conn is None or conn.is_closed():
+    conn = conn_class.connect(get_vtgate_addrs(), timeout,
+                              user=user, password=password)
+    _conns[key] = conn
   return conn
 
+def _close_connection(conn):
+  # close() also rolls back the open transaction, if any.
+  try:
+    conn.close()
+  except Exception as e:
+    logging.debug('error closing vtgate connection: %s', e)
+
+def close_connections():
+  for conn in _conns.itervalues():
+    _close_connection(conn)
+  _conns.clear()
+
+def discard_connection(user=None, password=None):
+  """Closes and forgets the cached connection, e.g. after a failed write.
+
+  This way its transaction does not stay open and keep its row locks.
+  """
+  conn = _conns.pop((user, password), None)
+  if conn is not None:
+    _close_connection(conn)
+
+# KeyRange objects are immutable once built, so one per shard name is kept.
+_KR_CACHE = {}
+
 def get_keyrange(shard_name):
-  kr = None
-  if shard_name == keyrange_constants.SHARD_ZERO:
-    kr = keyrange.KeyRange(keyrange_constants.NON_PARTIAL_KEYRANGE)
-  else:
-    kr = keyrange.KeyRange(shard_name)
+  kr = _KR_CACHE.get(shard_name)
+  if kr is None:
+    if shard_name == keyrange_constants.SHARD_ZERO:
+      kr = keyrange.KeyRange(keyrange_constants.NON_PARTIAL_KEYRANGE)
+    else:
+      kr = keyrange.KeyRange(shard_name)
+    _KR_CACHE[shard_name] = kr
   return kr
 
+# Single-keyrange lists for the cursor keyranges argument, one per shard
+# name. Callers must not modify them.
+_KR_LIST_CACHE = {}
+
+def get_keyranges(shard_name):
+  krs = _KR_LIST_CACHE.get(shard_name)
+  if krs is None:
+    krs = [get_keyrange(shard_name),]
+    _KR_LIST_CACHE[shard_name] = krs
+  return krs
+
+
+# "delete from <table>" for each of the test tables.
+_DELETE_SQL = dict((table_tuple[0], 'delete from %s' % table_tuple[0])
+                   for tables in topo_schema.keyspace_table_map.itervalues()
+                   for table_tuple in tables)
 
 def _delete_all(keyspace, shard_name, table_name):
   vtgate_conn = get_connection()
   # This write is to set up the test with fresh insert
   # and hence performing it directly on the connection.
   vtgate_conn.begin()
-  vtgate_conn._execute("delete from %s" % table_name, {},
-                       keyspace, 'master',
-                       keyranges=[get_keyrange(shard_name)])
-  vtgate_conn.commit()
+  try:
+    vtgate_conn._execute(_DELETE_SQL[table_name], {},
+                         keyspace, 'master',
+                         keyranges=get_keyranges(shard_name))
+    vtgate_conn.commit()
+  except:
+    discard_connection()
+    raise
+
 
+# Bumped by restart_vtgate. vtgate comes back on the same port, so this is
+# how connections made to the old one are told apart.
+_vtgate_generation = 0
 
 def restart_vtgate(extra_args={}):
-  global vtgate_server, vtgate_port
+  global vtgate_server, vtgate_port, _vtgate_generation
+  close_connections()
+  _vtgate_generation += 1
   utils.vtgate_kill(vtgate_server)
   vtgate_server, vtgate_port = utils.vtgate_start(vtgate_port, extra_args=extra_args)
 
+def _seed_rows(first_id):
+  return tuple((x, str(x)) for x in xrange(first_id, first_id + 10))
+
+# (id, msg) rows populate_table seeds into vt_unsharded.
+_SEED_ROWS = _seed_rows(0)
+# The insert for _SEED_ROWS is built once, its bind variables are only read.
+_SEED_INSERT_SQL, _SEED_INSERT_BIND_VARS = sql_builder.insert_many_query(
+    'vt_unsharded', ['id', 'msg'], _SEED_ROWS)
+
 def populate_table():
   keyspace = "KS_UNSHARDED"
   _delete_all(keyspace, keyrange_constants.SHARD_ZERO, 'vt_unsharded')
   vtgate_conn = get_connection()
-  cursor = vtgate_conn.cursor(keyspace, 'master', keyranges=[get_keyrange(keyrange_constants.SHARD_ZERO),],writable=True)
+  cursor = vtgate_conn.cursor(keyspace, 'master', keyranges=get_keyranges(keyrange_constants.SHARD_ZERO),writable=True)
   cursor.begin()
-  for x in xrange(10):
-    cursor.execute('insert into vt_unsharded (id, msg) values (%s, %s)' % (str(x), 'msg'), {})
-  cursor.commit()
+  try:
+    cursor.execute(_SEED_INSERT_SQL, _SEED_INSERT_BIND_VARS)
+    cursor.commit()
+  except:
+    discard_connection()
+    raise
 
 class TestUnshardedTable(unittest.TestCase):
 
+  # Each test seeds and works on its own range of ids, so the tests do not
+  # collide when utils.main runs them concurrently (--parallel). The ranges
+  # are handed out in setUpClass, in the order of the sorted test names.
+  seed_rows_by_test = None
+
+  # A DatabaseContext tracks a single transaction, so each thread running
+  # these tests gets its own.
+  _local = threading.local()
+  _contexts = []
+
+  @property
+  def dc(self):
+    return self._local.dc
+
+  @classmethod
+  def setUpClass(cls):
+    test_names = unittest.TestLoader().getTestCaseNames(cls)
+    cls.seed_rows_by_test = dict((name, _seed_rows(10 * i))
+                                 for i, name in enumerate(test_names))
+    cls.refresh_context()
+
+  @classmethod
+  def tearDownClass(cls):
+    for dc in cls._contexts:
+      cls._close_context(dc)
+    del cls._contexts[:]
+    cls._local = threading.local()
+
+  @staticmethod
+  def _close_context(dc):
+    if dc.vtgate_connection is None:
+      return
+    try:
+      dc.close()
+    except Exception as e:
+      logging.debug('error closing database context: %s', e)
+
+  @classmethod
+  def refresh_context(cls):
+    """Builds this thread's DatabaseContext, again if vtgate was restarted."""
+    local = cls._local
+    dc = getattr(local, 'dc', None)
+    if dc is not None and local.vtgate_generation == _vtgate_generation:
+      return
+    if dc is not None:
+      cls._close_context(dc)
+      cls._contexts.remove(dc)
+    local.dc = database_context.DatabaseContext(get_vtgate_addrs())
+    local.vtgate_generation = _vtgate_generation
+    cls._contexts.append(local.dc)
+
   def setUp(self):
-    self.vtgate_addrs = {"_vt": ["localhost:%s" % (vtgate_port),]}
-    self.dc = database_context.DatabaseContext(self.vtgate_addrs)
+    self.refresh_context()
+    seed_rows = self.seed_rows_by_test[self._testMethodName]
+    self.seed_ids = [row[0] for row in seed_rows]
+    self.test_id = self.seed_ids[2]
     with database_context.WriteTransaction(self.dc) as context:
-      for x in xrange(10):
-        db_class_unsharded.VtUnsharded.insert(context.get_cursor(),
-                                              id=x, msg=str(x))
+      db_class_unsharded.VtUnsharded.insert_many(context.get_cursor(),
+                                                 seed_rows)
 
   def tearDown(self):
-    _delete_all("KS_UNSHARDED", "0", 'vt_unsharded')
+    where_column_value_pairs = [
+        ('id', sql_builder.GreaterThanOrEqualToValue(self.seed_ids[0])),
+        ('id', sql_builder.LessThanOrEqualToValue(self.seed_ids[-1]))]
+    with database_context.WriteTransaction(self.dc) as context:
+      db_class_unsharded.VtUnsharded.delete_by_columns(context.get_cursor(),
+                                                    where_column_value_pairs)
 
+  @unittest.skipIf(fused_crud_tests, 'covered by test_crud')
   def test_read(self):
     with database_context.ReadFromMaster(self.dc) as context:
       rows = db_class_unsharded.VtUnsharded.select_by_id(
-          context.get_cursor(), 2)
+          context.get_cursor(), self.test_id)
       self.assertEqual(len(rows), 1, "wrong number of rows fetched")
       for row in rows:
         logging.info("ROW: %s" % row)
-      self.assertEqual(rows[0].id, 2, "wrong row fetched")
+      self.assertEqual(rows[0].id, self.test_id, "wrong row fetched")
 
+  @unittest.skipIf(fused_crud_tests, 'covered by test_crud')
   def test_update_and_read(self):
-    where_column_value_pairs = [('id', 2)]
+    where_column_value_pairs = [('id', self.test_id)]
     with database_context.WriteTransaction(self.dc) as context:
       db_class_unsharded.VtUnsharded.update_columns(context.get_cursor(),
                                                     where_column_value_pairs,
                                                     msg="test update")
 
     with database_context.ReadFromMaster(self.dc) as context:
-      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(), 2)
+      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(),
+                                                         self.test_id)
       self.assertEqual(len(rows), 1, "wrong number of rows fetched")
       self.assertEqual(rows[0].msg, "test update", "wrong row fetched")
 
+  @unittest.skipIf(fused_crud_tests, 'covered by test_crud')
   def test_delete_and_read(self):
-    where_column_value_pairs = [('id', 2)]
+    where_column_value_pairs = [('id', self.test_id)]
     with database_context.WriteTransaction(self.dc) as context:
       db_class_unsharded.VtUnsharded.delete_by_columns(context.get_cursor(),
                                                     where_column_value_pairs)
 
     with database_context.ReadFromMaster(self.dc) as context:
-      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(), 2)
+      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(),
+                                                         self.test_id)
       self.assertEqual(len(rows), 0, "wrong number of rows fetched")
 
+  def test_crud(self):
+    """Same checks as the other tests, with a single write transaction."""
+    update_id = self.test_id
+    delete_id = self.seed_ids[3]
+    with database_context.ReadFromMaster(self.dc) as context:
+      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(),
+                                                         update_id)
+      self.assertEqual(len(rows), 1, "read: wrong number of rows fetched")
+      self.assertEqual(rows[0].id, update_id, "read: wrong row fetched")
+
+    with database_context.WriteTransaction(self.dc) as context:
+      db_class_unsharded.VtUnsharded.update_columns(context.get_cursor(),
+                                                    [('id', update_id)],
+                                                    msg="test update")
+      db_class_unsharded.VtUnsharded.delete_by_columns(context.get_cursor(),
+                                                    [('id', delete_id)])
+
+    with database_context.ReadFromMaster(self.dc) as context:
+      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(),
+                                                         update_id)
+      self.assertEqual(len(rows), 1, "update: wrong number of rows fetched")
+      self.assertEqual(rows[0].msg, "test update", "update: wrong row fetched")
+      rows = db_class_unsharded.VtUnsharded.select_by_id(context.get_cursor(),
+                                                         delete_id)
+      self.assertEqual(len(rows), 0, "delete: wrong number of rows fetched")
+
 
 if __name__ == '__main__':
   utils.main()
@@ -7,6 +7,7 @@ and its related methods.
 import topo_schema
 from vtdb import db_object
 from vtdb import database_context
+from vtdb import sql_builder
 
 class VtUnsharded(db_object.DBObjectUnsharded):
   keyspace = topo_schema.KS_UNSHARDED[0]
@@ -17,3 +18,11 @@ class VtUnsharded(db_object.DBObjectUnsharded):
   def select_by_id(class_, cursor, id_val):
     where_column_value_pairs = [('id', id_val),]
     return class_.select_by_columns(cursor, where_column_value_pairs)
+
+  @db_object.db_class_method
+  def insert_many(class_, cursor, rows):
+    """Inserts rows, a list of (id, msg) tuples, in a single statement."""
+    query, bind_variables = sql_builder.insert_many_query(
+        class_.table_name, class_.columns_list, rows)
+    cursor.execute(query, bind_variables)
+    return cursor.rowcount
@@ -514,29 +514,39 @@ class Tablet(object):
   def wait_for_vttablet_state(self, expected, timeout=60.0, port=None):
     self.wait_for_vtocc_state(expected, timeout=timeout, port=port)
 
+  def get_vttablet_state(self, port=None):
+    return self.get_vtocc_state(port=port)
+
   def wait_for_vtocc_state(self, expected, timeout=60.0, port=None):
     while True:
-      v = utils.get_vars(port or self.port)
-      if v == None:
-        logging.debug(
-            '  vttablet %s not answering at /debug/vars, waiting...',
-            self.tablet_alias)
-      else:
-        if 'TabletStateName' not in v:
-          logging.debug(
-              '  vttablet %s not exporting TabletStateName, waiting...',
-              self.tablet_alias)
-        else:
-          s = v['TabletStateName']
-          if s != expected:
-            logging.debug(
-                '  vttablet %s in state %s != %s', self.tablet_alias, s,
-                expected)
-          else:
-            break
+      s = self.get_vtocc_state(port=port)
+      if s == expected:
+        break
+      self._log_state_wait(s, expected)
       timeout = utils.wait_step('waiting for state %s' % expected, timeout,
                                 sleep_time=0.1)
 
+  def _log_state_wait(self, s, expected):
+    if s is None:
+      logging.debug(
+          '  vttablet %s not answering at /debug/vars or not exporting '
+          'TabletStateName, waiting...', self.tablet_alias)
+    else:
+      logging.debug(
+          '  vttablet %s in state %s != %s, waiting...', self.tablet_alias, s,
+          expected)
+
+  def get_vtocc_state(self, port=None):
+    """Returns the current TabletStateName of the server, without waiting.
+
+    None is returned if the server is not answering or not exporting
+    its state yet.
+    """
+    v = utils.get_vars(port or self.port)
+    if v == None:
+      return None
+    return v.get('TabletStateName')
+
   def wait_for_mysqlctl_socket(self, timeout=10.0):
     mysql_sock = os.path.join(self.tablet_dir, 'mysql.sock')
     mysqlctl_sock = os.path.join(self.tablet_dir, 'mysqlctl.sock')
@@ -618,6 +628,29 @@ class Tablet(object):
       raise utils.TestError('This test is not killing all its vttablets')
 
 
+def wait_for_tablets_state(tablets, expected, timeout=60.0):
+  """Waits until all the vttablets are in the expected state.
+
+  All the tablets are polled in each round, so the wait lasts as long as
+  the slowest tablet takes, not the sum over the tablets.
+  """
+  pending = list(tablets)
+  while True:
+    still_pending = []
+    for t in pending:
+      s = t.get_vttablet_state()
+      if s != expected:
+        t._log_state_wait(s, expected)
+        still_pending.append(t)
+    pending = still_pending
+    if not pending:
+      return
+    timeout = utils.wait_step(
+        'waiting for state %s on %s' % (
+            expected, ' '.join(t.tablet_alias for t in pending)),
+        timeout, sleep_time=0.1)
+
+
 def kill_tablets(tablets):
   for t in tablets:
     logging.debug('killing vttablet: %s', t.tablet_alias)
@@ -2,6 +2,8 @@
 
 import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import optparse
 import os
 import shlex
@@ -67,6 +69,11 @@ def add_options(parser):
   parser.add_option("--mysql-flavor")
   parser.add_option("--protocols-flavor")
   parser.add_option("--topo-server-flavor", default="zookeeper")
+  parser.add_option('--parallel', type='int', default=1,
+                    help='Number of test methods to run concurrently, 0 picks '
+                    'one per cpu. Only for modules with independent tests. '
+                    'Unlike the serial run, it does not stop at the first '
+                    'failure.')
 
 def set_options(opts):
   global options
@@ -87,6 +94,8 @@ def main(mod=None):
   parser = optparse.OptionParser(usage="usage: %prog [options] [test_names]")
   add_options(parser)
   (options, args) = parser.parse_args()
+  if options.parallel < 0:
+    parser.error('--parallel cannot be negative')
 
   if options.verbose == 0:
     level = logging.WARNING
@@ -117,9 +126,13 @@ def main(mod=None):
           suite.addTests(unittest.TestLoader().loadTestsFromName(arg, mod))
 
     if suite.countTestCases() > 0:
-      logger = LoggingStream()
-      result = unittest.TextTestRunner(stream=logger, verbosity=options.verbose, failfast=True).run(suite)
-      if not result.wasSuccessful():
+      if options.parallel != 1:
+        successful = run_parallel(mod, suite, options.parallel)
+      else:
+        logger = LoggingStream()
+        result = unittest.TextTestRunner(stream=logger, verbosity=options.verbose, failfast=True).run(suite)
+        successful = result.wasSuccessful()
+      if not successful:
         sys.exit(-1)
   except KeyboardInterrupt:
     logging.warning("======== Tests interrupted, cleaning up ========")
@@ -131,6 +144,81 @@ def main(mod=None):
       logging.warning("Leaving temporary files behind (--keep-logs), please "
                       "clean up before next run: " + os.environ["VTDATAROOT"])
 
+# run_parallel waits at most this many seconds for the tests.
+_PARALLEL_TIMEOUT = 24 * 3600
+
+def _flatten_suite(suite):
+  for test in suite:
+    if isinstance(test, unittest.TestSuite):
+      for t in _flatten_suite(test):
+        yield t
+    else:
+      yield test
+
+# run_parallel runs the test methods of the suite on a pool of threads, and
+# returns True if they all passed. The module and class fixtures are run
+# once around the whole batch, so the test methods have to be independent.
+# If processes is 0, one thread per cpu is used.
+def run_parallel(mod, suite, processes):
+  tests = list(_flatten_suite(suite))
+  if not processes:
+    processes = multiprocessing.cpu_count()
+  processes = min(processes, len(tests))
+
+  classes = []
+  for test in tests:
+    if test.__class__ not in classes:
+      classes.append(test.__class__)
+
+  def run_test(test):
+    result = unittest.TestResult()
+    test(result)
+    return result
+
+  if hasattr(mod, 'setUpModule'):
+    mod.setUpModule()
+  # only the classes whose setUpClass went through are torn down
+  set_up = []
+  try:
+    for cls in classes:
+      cls.setUpClass()
+      set_up.append(cls)
+    pool = ThreadPool(processes=processes)
+    # In python 2.7 pool.map() cannot be interrupted, a get() with a
+    # timeout can.
+    results = pool.map_async(run_test, tests).get(_PARALLEL_TIMEOUT)
+    pool.close()
+    pool.join()
+  except KeyboardInterrupt:
+    # main() tears the module down in that case. The pool threads are
+    # daemons, so the still running tests do not hold up the exit.
+    raise
+  except:
+    _tear_down_parallel(mod, set_up)
+    raise
+  _tear_down_parallel(mod, set_up)
+
+  failed = []
+  skipped = 0
+  for result in results:
+    for test, err in result.errors + result.failures:
+      logging.error("%s failed:\n%s", test.id(), err)
+      failed.append(test.id())
+    skipped += len(result.skipped)
+  logging.info("Ran %d tests on %d threads, %d failed, %d skipped",
+               len(tests), processes, len(failed), skipped)
+  if failed:
+    logging.error("Failed tests: %s", ", ".join(failed))
+  return not failed
+
+def _tear_down_parallel(mod, classes):
+  try:
+    for cls in classes:
+      cls.tearDownClass()
+  finally:
+    if hasattr(mod, 'tearDownModule'):
+      mod.tearDownModule()
+
 def remove_tmp_files():
   if options.keep_logs:
     return
@@ -237,6 +325,9 @@ def run_bg(cmd, **kargs):
   _add_proc(proc)
   return proc
 
+# wait_procs waits for all the processes to exit. Each proc.wait() blocks
+# in waitpid() without polling, so the total wait is the one of the slowest
+# process, not the sum over the list.
 def wait_procs(proc_list, raise_on_error=True):
   for proc in proc_list:
     pid = proc.pid